@@ -1,10 +1,41 @@
 import sys
+import asyncio
 import logging
 
-from typing import Any
+from typing import Any, Final
 from argparse import ArgumentParser
 
-from can import BusABC, Bus
+from can import Message
+from can_peak_gateway import BusPeakGateway
+
+QUEUE_SIZE: Final[int] = 1024
+
+
+async def dump(bus: BusPeakGateway) -> None:
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    queue: asyncio.Queue[Message] = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    # Each receive buffers one batch of datagrams, and recv() returns None for dropped frames, so read until nothing
+    # buffered is left, then give the loop back. The reader is level-triggered and runs again while the kernel still
+    # holds datagrams.
+    def on_readable() -> None:
+        while True:
+            message: Message | None = bus.recv(0)
+            if message is not None:
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    logging.warning("queue full, message dropped")
+            if not bus.pending:
+                break
+
+    loop.add_reader(bus.recv_fileno(), on_readable)
+    try:
+        while True:
+            print(await queue.get())
+    finally:
+        loop.remove_reader(bus.recv_fileno())
+
 
 if __name__ == "__main__":
     parser: ArgumentParser = ArgumentParser(description="Dump the CAN bus from a Ethernet gateway")
@@ -20,8 +51,7 @@ if __name__ == "__main__":
         format="%(asctime)s - %(levelname)s - %(message)s",
     )
 
-    bus: BusABC = Bus(
-        interface="peak-gatewasy",
+    bus: BusPeakGateway = BusPeakGateway(
         send_host=args.send_host,
         send_port=args.send_port,
         recv_host=args.recv_host,
@@ -29,8 +59,7 @@ if __name__ == "__main__":
     )
 
     try:
-        while True:
-            print(bus.recv())
+        asyncio.run(dump(bus))
     except KeyboardInterrupt:
         pass
 
@@ -1,9 +1,32 @@
+import errno
 import logging
+import os
+import sys
 import time
 
-from socket import socket, AF_INET, SOCK_DGRAM
-from typing import final, override, Tuple, Final, List
-from ctypes import BigEndianStructure, c_uint16, c_uint64, c_uint32, c_uint8, sizeof
+from itertools import product
+from select import POLLIN, poll
+from socket import socket, AF_INET, CMSG_LEN, CMSG_SPACE, MSG_TRUNC, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+from struct import Struct
+from typing import final, override, Any, Iterable, Tuple, Final, List
+from ctypes import (
+    BigEndianStructure,
+    CDLL,
+    POINTER,
+    Structure,
+    addressof,
+    c_int,
+    c_size_t,
+    c_uint,
+    c_uint16,
+    c_uint64,
+    c_uint32,
+    c_uint8,
+    c_void_p,
+    get_errno,
+    pointer,
+    sizeof,
+)
 from enum import IntEnum
 from can import BusABC, Message
 
@@ -15,6 +38,12 @@ class MessageType(IntEnum):
     CAN_FD_FRAME_CRC = 0x91
 
 
+# Plain int copies of MessageType, comparing and hashing them skips the enum machinery.
+KIND_CAN_FRAME: Final[int] = int(MessageType.CAN_FRAME)
+KIND_CAN_FRAME_CRC: Final[int] = int(MessageType.CAN_FRAME_CRC)
+KIND_CAN_FD_FRAME: Final[int] = int(MessageType.CAN_FD_FRAME)
+KIND_CAN_FD_FRAME_CRC: Final[int] = int(MessageType.CAN_FD_FRAME_CRC)
+
 FLAG_REMOTE_REQUEST: Final[int] = 0x01
 FLAG_EXTENDED_IDENTIFIER: Final[int] = 0x02
 FLAG_EXTENDED_DATA_LENGTH: Final[int] = 0x10
@@ -27,6 +56,19 @@ MASK_CAN_ID_EXTENDED_FRAME: Final[int] = 1 << 31
 
 FETCH_SIZE_STANDARD_FRAME: Final[int] = 8
 FETCH_SIZE_OPTIONAL_CRC: Final[int] = 4
+FETCH_SIZE_MAX_PAYLOAD: Final[int] = 64
+
+RECV_SIZE_DATAGRAM: Final[int] = 65535
+RECV_BATCH_SIZE: Final[int] = 16
+
+SEND_BATCH_SIZE: Final[int] = 64
+
+SOCKET_RECV_BUFFER_SIZE: Final[int] = 12 * 1024 * 1024
+SOCKET_SEND_BUFFER_SIZE: Final[int] = 4 * 1024 * 1024
+
+# Linux socket option, not exported by the socket module, the kernel attaches a timespec to every datagram.
+SO_TIMESTAMPNS: Final[int] = 35
+SCM_TIMESTAMPNS: Final[int] = SO_TIMESTAMPNS
 
 
 class MessageHeader(BigEndianStructure):
@@ -79,21 +121,309 @@ class MessageHeader(BigEndianStructure):
         return " ".join(components)
 
 
+# Maps each frame kind to whether it is a CAN FD frame and the size of the CRC trailing the payload.
+FRAME_KIND_TABLE: Final[dict[int, tuple[bool, int]]] = {
+    KIND_CAN_FRAME: (False, 0),
+    KIND_CAN_FRAME_CRC: (False, FETCH_SIZE_OPTIONAL_CRC),
+    KIND_CAN_FD_FRAME: (True, 0),
+    KIND_CAN_FD_FRAME_CRC: (True, FETCH_SIZE_OPTIONAL_CRC),
+}
+
+# Same layout as MessageHeader. The unused tag, timestamps and channel are padding: skipped when unpacking, zero
+# when packing.
+HEADER_STRUCT: Final[Struct] = Struct(">HH17xBHI")
+HEADER_SIZE: Final[int] = HEADER_STRUCT.size
+
+FRAME_SIZE_MAX: Final[int] = HEADER_SIZE + FETCH_SIZE_MAX_PAYLOAD
+ZERO_PADDING: Final[bytes] = bytes(FETCH_SIZE_MAX_PAYLOAD)
+
+TIMESPEC_STRUCT: Final[Struct] = Struct("@ll")
+# struct cmsghdr: cmsg_len, cmsg_level, cmsg_type.
+CMSG_HEADER_STRUCT: Final[Struct] = Struct("@Nii")
+
+
+def encode_frame_options(
+    is_fd: bool, is_remote_frame: bool, is_extended_id: bool, is_error_frame: bool, bitrate_switch: bool
+) -> tuple[int, int, int]:
+    frame_kind: int = KIND_CAN_FRAME
+    frame_flags: int = 0
+    frame_id_bits: int = 0
+
+    if is_fd:
+        frame_kind = KIND_CAN_FD_FRAME
+    elif is_remote_frame:
+        frame_flags |= FLAG_REMOTE_REQUEST
+        frame_id_bits |= MASK_CAN_ID_REMOTE_REQUEST
+
+    if is_extended_id:
+        frame_flags |= FLAG_EXTENDED_IDENTIFIER
+
+    if is_error_frame:
+        frame_flags |= FLAG_ERROR_STATE
+
+    if bitrate_switch:
+        frame_flags |= FLAG_BITRATE_SWITCH
+
+    return (frame_kind, frame_flags, frame_id_bits)
+
+
+# Maps (is_fd, is_remote_frame, is_extended_id, is_error_frame, bitrate_switch) to the frame kind, flags and id bits.
+FRAME_OPTIONS_TABLE: Final[dict[tuple[bool, ...], tuple[int, int, int]]] = {
+    options: encode_frame_options(*options) for options in product((False, True), repeat=5)
+}
+
+
+def pack_frame(msg: Message, buffer: memoryview) -> int:
+    # python-can does not coerce these fields, so they are looked up by truthiness.
+    frame_kind, frame_flags, frame_id_bits = FRAME_OPTIONS_TABLE[
+        (
+            bool(msg.is_fd),
+            bool(msg.is_remote_frame),
+            bool(msg.is_extended_id),
+            bool(msg.is_error_frame),
+            bool(msg.bitrate_switch),
+        )
+    ]
+
+    packet_size: int = HEADER_SIZE + (msg.dlc if msg.is_fd else FETCH_SIZE_STANDARD_FRAME)
+    HEADER_STRUCT.pack_into(
+        buffer, 0, packet_size, frame_kind, msg.dlc, frame_flags, msg.arbitration_id | frame_id_bits
+    )
+
+    data_end: int = HEADER_SIZE + len(msg.data)
+    buffer[HEADER_SIZE:data_end] = msg.data
+    if data_end < packet_size:
+        buffer[data_end:packet_size] = ZERO_PADDING[: packet_size - data_end]
+
+    return packet_size
+
+
+class IoVec(Structure):
+    _fields_ = [
+        ("iov_base", c_void_p),
+        ("iov_len", c_size_t),
+    ]
+
+
+class MsgHdr(Structure):
+    _fields_ = [
+        ("msg_name", c_void_p),
+        ("msg_namelen", c_uint32),
+        ("msg_iov", POINTER(IoVec)),
+        ("msg_iovlen", c_size_t),
+        ("msg_control", c_void_p),
+        ("msg_controllen", c_size_t),
+        ("msg_flags", c_int),
+    ]
+
+
+class MMsgHdr(Structure):
+    _fields_ = [
+        ("msg_hdr", MsgHdr),
+        ("msg_len", c_uint),
+    ]
+
+
+LIBC: Final[CDLL | None] = CDLL(None, use_errno=True) if sys.platform == "linux" else None
+
+
+def libc_function(name: str, argtypes: list[Any]) -> Any | None:
+    # Only Linux provides sendmmsg and recvmmsg, other platforms fall back to one datagram per syscall.
+    if LIBC is None or not hasattr(LIBC, name):
+        return None
+
+    function: Any = getattr(LIBC, name)
+    function.argtypes = argtypes
+    function.restype = c_int
+    return function
+
+
+class SocketBatchSender:
+    def __init__(self, sock: socket, size: int = SEND_BATCH_SIZE) -> None:
+        self._socket: socket = sock
+        self._size: int = size
+        self._buffer = (c_uint8 * (size * FRAME_SIZE_MAX))()
+        view: memoryview = memoryview(self._buffer).cast("B")
+        self._slots: list[memoryview] = [view[i * FRAME_SIZE_MAX : (i + 1) * FRAME_SIZE_MAX] for i in range(size)]
+        self._sendmmsg: Any | None = libc_function("sendmmsg", [c_int, c_void_p, c_uint, c_int])
+
+        self._iovecs = (IoVec * size)()
+        self._headers = (MMsgHdr * size)()
+        base: int = addressof(self._buffer)
+        for i in range(size):
+            self._iovecs[i].iov_base = base + i * FRAME_SIZE_MAX
+            self._headers[i].msg_hdr.msg_iov = pointer(self._iovecs[i])
+            self._headers[i].msg_hdr.msg_iovlen = 1
+
+    def send(self, msgs: Iterable[Message]) -> None:
+        count: int = 0
+        for msg in msgs:
+            packet_size: int = pack_frame(msg, self._slots[count])
+            self._iovecs[count].iov_len = packet_size
+            count += 1
+            if count == self._size:
+                self._flush(count)
+                count = 0
+
+        if count:
+            self._flush(count)
+
+    def _flush(self, count: int) -> None:
+        if self._sendmmsg is None:
+            for i in range(count):
+                self._socket.send(self._slots[i][: self._iovecs[i].iov_len])
+            return
+
+        sent: int = 0
+        while sent < count:
+            headers: int = addressof(self._headers) + sent * sizeof(MMsgHdr)
+            result: int = self._sendmmsg(self._socket.fileno(), headers, count - sent, 0)
+            if result < 0:
+                error: int = get_errno()
+                if error == errno.EINTR:
+                    continue
+                raise OSError(error, os.strerror(error))
+            sent += result
+
+
 class SocketReader:
-    def __init__(self, sock: socket) -> None:
+    def __init__(self, sock: socket, size: int = RECV_BATCH_SIZE) -> None:
         self._socket: socket = sock
-        self._buffer: bytearray = bytearray()
+        self._socket.setblocking(False)
+        self._poll = poll()
+        self._poll.register(self._socket, POLLIN)
+
+        self._recvmmsg: Any | None = libc_function("recvmmsg", [c_int, c_void_p, c_uint, c_int, c_void_p])
+        self._size: int = size if self._recvmmsg is not None else 1
+        self._control_size: int = CMSG_SPACE(TIMESPEC_STRUCT.size)
+        self._buffer = (c_uint8 * (self._size * RECV_SIZE_DATAGRAM))()
+        self._view: memoryview = memoryview(self._buffer).cast("B")
+        self._control = (c_uint8 * (self._size * self._control_size))()
+        self._control_view: memoryview = memoryview(self._control).cast("B")
+
+        self._iovecs = (IoVec * self._size)()
+        self._headers = (MMsgHdr * self._size)()
+        for i in range(self._size):
+            self._iovecs[i].iov_base = addressof(self._buffer) + i * RECV_SIZE_DATAGRAM
+            self._iovecs[i].iov_len = RECV_SIZE_DATAGRAM
+            self._headers[i].msg_hdr.msg_iov = pointer(self._iovecs[i])
+            self._headers[i].msg_hdr.msg_iovlen = 1
+            self._headers[i].msg_hdr.msg_control = addressof(self._control) + i * self._control_size
+            self._headers[i].msg_hdr.msg_controllen = self._control_size
+
+        # Length, flags and arrival time of each datagram of the current batch.
+        self._datagrams: list[tuple[int, int, float]] = []
+        self._filled: int = 0
+        self._index: int = 0
+        self._read_pos: int = 0
+        self._end_pos: int = 0
+        self.timestamp: float = 0.0
+
+    @staticmethod
+    def _arrival_time(ancdata: list[tuple[int, int, bytes]]) -> float:
+        for level, kind, data in ancdata:
+            if level == SOL_SOCKET and kind == SCM_TIMESTAMPNS:
+                seconds, nanoseconds = TIMESPEC_STRUCT.unpack_from(data)
+                return seconds + nanoseconds * 1e-9
+
+        return time.time()
+
+    def _control_arrival_time(self, offset: int, size: int) -> float:
+        end: int = offset + size
+        while offset + CMSG_LEN(0) <= end:
+            length, level, kind = CMSG_HEADER_STRUCT.unpack_from(self._control_view, offset)
+            if level == SOL_SOCKET and kind == SCM_TIMESTAMPNS:
+                seconds, nanoseconds = TIMESPEC_STRUCT.unpack_from(self._control_view, offset + CMSG_LEN(0))
+                return seconds + nanoseconds * 1e-9
+            if length < CMSG_LEN(0):
+                break
+            offset += CMSG_SPACE(length - CMSG_LEN(0))
+
+        return time.time()
+
+    def _receive_batch(self) -> None:
+        if self._recvmmsg is None:
+            nbytes, ancdata, flags, _ = self._socket.recvmsg_into([self._view], self._control_size)
+            self._datagrams = [(nbytes, flags, self._arrival_time(ancdata))]
+            return
+
+        # The kernel overwrites msg_controllen with the size it used, so restore it on the headers it filled.
+        for i in range(self._filled):
+            self._headers[i].msg_hdr.msg_controllen = self._control_size
+        self._filled = 0
+
+        count: int = self._recvmmsg(self._socket.fileno(), addressof(self._headers), self._size, 0, None)
+        while count < 0:
+            error: int = get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise BlockingIOError(error, os.strerror(error))
+            if error != errno.EINTR:
+                raise OSError(error, os.strerror(error))
+            count = self._recvmmsg(self._socket.fileno(), addressof(self._headers), self._size, 0, None)
+
+        self._filled = count
+        self._datagrams = [
+            (
+                header.msg_len,
+                header.msg_hdr.msg_flags,
+                self._control_arrival_time(i * self._control_size, header.msg_hdr.msg_controllen),
+            )
+            for i, header in enumerate(self._headers[:count])
+        ]
+
+    def _receive(self, timeout: float | None) -> None:
+        # Try the non-blocking receive first, so a busy socket costs one syscall per batch of datagrams.
+        try:
+            self._receive_batch()
+            return
+        except BlockingIOError:
+            if timeout == 0:
+                raise
 
-    def read(self, size: int, timeout: float | None) -> bytes:
-        if len(self._buffer) < size:
-            self._socket.settimeout(timeout)
-            data: bytes = self._socket.recv(1024)
-            self._buffer.extend(data)
+        if not self._poll.poll(None if timeout is None else timeout * 1000):
+            raise TimeoutError()
 
-        data = self._buffer[:size]
-        self._buffer = self._buffer[size:]
+        self._receive_batch()
 
-        return data
+    @property
+    def pending(self) -> bool:
+        return self._read_pos < self._end_pos or self._index < len(self._datagrams)
+
+    def read_frame(self, timeout: float | None) -> tuple[tuple[int, int, int, int, int], memoryview] | None:
+        # A datagram holds one or more whole frames, the next one is only used once the last is consumed.
+        if self._read_pos >= self._end_pos:
+            if self._index >= len(self._datagrams):
+                self._datagrams = []
+                self._index = 0
+                self._receive(timeout)
+
+            nbytes, flags, self.timestamp = self._datagrams[self._index]
+            self._read_pos = self._index * RECV_SIZE_DATAGRAM
+            self._end_pos = self._read_pos + nbytes
+            self._index += 1
+
+            if flags & MSG_TRUNC:
+                logging.warning(f"truncated datagram dropped: larger than {RECV_SIZE_DATAGRAM} bytes")
+                self._end_pos = self._read_pos
+                return None
+
+        # The header is decoded once here, the caller gets it along with the frame.
+        remaining: int = self._end_pos - self._read_pos
+        header: tuple[int, int, int, int, int] = (0, 0, 0, 0, 0)
+        if remaining >= HEADER_SIZE:
+            header = HEADER_STRUCT.unpack_from(self._view, self._read_pos)
+
+        packet_size: int = header[0]
+        if packet_size < HEADER_SIZE or packet_size > remaining:
+            logging.warning(f"malformed datagram dropped: {remaining} bytes left, packet size {packet_size}")
+            self._read_pos = self._end_pos
+            return None
+
+        # The view aliases the internal buffer and is only valid until the next read.
+        frame: memoryview = self._view[self._read_pos : self._read_pos + packet_size]
+        self._read_pos += packet_size
+
+        return (header, frame)
 
 
 @final
@@ -106,90 +436,87 @@ class BusPeakGateway(BusABC):
         recv_port: int = 40000,
     ) -> None:
         self._send_socket: socket = socket(AF_INET, SOCK_DGRAM)
+        self._send_socket.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_SEND_BUFFER_SIZE)
         self._send_socket.connect((send_host, send_port))
         self._recv_socket: socket = socket(AF_INET, SOCK_DGRAM)
+        self._recv_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_RECV_BUFFER_SIZE)
         self._recv_socket.bind((recv_host, recv_port))
+        if sys.platform == "linux":
+            self._recv_socket.setsockopt(SOL_SOCKET, SO_TIMESTAMPNS, 1)
+
+        # The kernel silently caps the sizes to net.core.rmem_max and net.core.wmem_max.
+        logging.debug(
+            f"socket buffers: recv={self._recv_socket.getsockopt(SOL_SOCKET, SO_RCVBUF)} "
+            f"send={self._send_socket.getsockopt(SOL_SOCKET, SO_SNDBUF)}"
+        )
+
         self._recv_buffer: SocketReader = SocketReader(self._recv_socket)
+        self._send_buffer: bytearray = bytearray(FRAME_SIZE_MAX)
+        self._send_view: memoryview = memoryview(self._send_buffer)
+        self._send_batch: SocketBatchSender = SocketBatchSender(self._send_socket)
 
         super().__init__(channel=f"{send_host}:{send_port}")
 
     @override
     def send(self, msg: Message, timeout: float | None = None) -> None:
         _ = timeout
-        header: MessageHeader = MessageHeader(
-            packet_size=sizeof(MessageHeader),
-            unused_tag=0,
-            timestamp_low=0,
-            timestamp_high=0,
-            channel=0,
-            frame_size=msg.dlc,
-            frame_id_raw=msg.arbitration_id,
-        )
+        packet_size: int = pack_frame(msg, self._send_view)
+        self._send_socket.send(self._send_view[:packet_size])
 
-        if msg.is_fd:
-            header.packet_size += msg.dlc
-            header.frame_kind = MessageType.CAN_FD_FRAME
-        else:
-            header.packet_size += FETCH_SIZE_STANDARD_FRAME
-            header.frame_kind = MessageType.CAN_FRAME
-            if msg.is_remote_frame:
-                header.frame_flags |= FLAG_REMOTE_REQUEST
-                header.frame_id_raw |= MASK_CAN_ID_REMOTE_REQUEST
+    @property
+    def pending(self) -> bool:
+        return self._recv_buffer.pending
 
-        if msg.is_extended_id:
-            header.frame_flags |= FLAG_EXTENDED_IDENTIFIER
+    # Not exposed as fileno(): python-can's Notifier reads a single frame per wakeup, which would leave the other
+    # frames of a datagram buffered until the next one arrives. Readers using it must drain while pending is set.
+    def recv_fileno(self) -> int:
+        return self._recv_socket.fileno()
 
-        if msg.is_error_frame:
-            header.frame_flags |= FLAG_ERROR_STATE
+    def send_batch(self, msgs: Iterable[Message], timeout: float | None = None) -> None:
+        _ = timeout
+        self._send_batch.send(msgs)
 
-        if msg.bitrate_switch:
-            header.frame_flags |= FLAG_BITRATE_SWITCH
+    @override
+    def _recv_internal(self, timeout: float | None = None) -> Tuple[Message | None, bool]:
+        try:
+            received: tuple[tuple[int, int, int, int, int], memoryview] | None = self._recv_buffer.read_frame(timeout)
+        except (TimeoutError, BlockingIOError):
+            return (None, False)
 
-        frame: bytearray = bytearray(header)
-        if msg.is_fd:
-            frame.extend(msg.data)
-        else:
-            data: bytearray = bytearray([0] * FETCH_SIZE_STANDARD_FRAME)
-            data[: len(msg.data)] = msg.data
-            frame.extend(data)
+        if received is None:
+            return (None, False)
 
-        self._send_socket.send(frame)
+        header, frame = received
+        _, frame_kind, frame_size, frame_flags, frame_id_raw = header
 
-    @override
-    def _recv_internal(self, timeout: float | None = None) -> Tuple[Message | None, bool]:
-        message: Message = Message()
+        frame_info: tuple[bool, int] | None = FRAME_KIND_TABLE.get(frame_kind)
+        if frame_info is None:
+            logging.warning(f"unknown frame type received: {hex(frame_kind)}")
+            return (None, False)
 
-        try:
-            header_data: bytes = self._recv_buffer.read(sizeof(MessageHeader), timeout)
-            header: MessageHeader = MessageHeader.from_buffer_copy(header_data)
-        except TimeoutError:
+        is_fd, crc_size = frame_info
+        fetch_size: int = frame_size if is_fd else FETCH_SIZE_STANDARD_FRAME
+        payload_end: int = len(frame) - crc_size
+        if payload_end - HEADER_SIZE < fetch_size:
+            logging.warning(f"short frame received: {len(frame)} bytes for {fetch_size} bytes of payload")
             return (None, False)
 
-        fetch_crc: bool = header.frame_kind in {MessageType.CAN_FRAME_CRC | MessageType.CAN_FD_FRAME_CRC}
-        fetch_size: int = FETCH_SIZE_STANDARD_FRAME
-        frame_size: int = header.frame_size
-        match header.frame_kind:
-            case MessageType.CAN_FRAME | MessageType.CAN_FRAME_CRC:
-                message.is_remote_frame = header.flag_remote_request_frame
-            case MessageType.CAN_FD_FRAME | MessageType.CAN_FD_FRAME_CRC:
-                message.is_fd = True
-                message.is_error_frame = header.flag_error_state_indicator
-                message.bitrate_switch = header.flag_activated_bitrate_switch
-                fetch_size = header.frame_size
-            case frame:
-                logging.warning(f"unknown frame type received: {hex(frame)}")
-                return (None, False)
-
-        payload_data: bytes = self._recv_buffer.read(fetch_size, timeout)
-        if fetch_crc:
-            crc_data: bytes = self._recv_buffer.read(FETCH_SIZE_OPTIONAL_CRC, timeout)
-            # TODO: check CRC data
-            _ = crc_data
-
-        message.timestamp = time.time()
-        message.arbitration_id = header.frame_id
-        message.is_extended_id = header.frame_extended_id
-        message.dlc = frame_size
-        message.data = bytearray(payload_data[:frame_size])
+        # TODO: check CRC data, the algorithm is not confirmed against the PEAK documentation or a captured frame.
+
+        # Classic frames may carry a DLC of 9 to 15, which still means 8 bytes of payload.
+        data_size: int = min(frame_size, fetch_size)
+        data: bytearray = bytearray(frame[HEADER_SIZE : HEADER_SIZE + data_size])
+
+        message: Message = Message(
+            timestamp=self._recv_buffer.timestamp,
+            arbitration_id=frame_id_raw & MASK_CAN_ID,
+            is_extended_id=bool(frame_id_raw & MASK_CAN_ID_EXTENDED_FRAME),
+            is_remote_frame=not is_fd and bool(frame_flags & FLAG_REMOTE_REQUEST),
+            is_error_frame=is_fd and bool(frame_flags & FLAG_ERROR_STATE),
+            dlc=data_size,
+            data=data,
+            is_fd=is_fd,
+            bitrate_switch=is_fd and bool(frame_flags & FLAG_BITRATE_SWITCH),
+        )
 
         return (message, False)
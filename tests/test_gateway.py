@@ -0,0 +1,268 @@
+import asyncio
+import errno
+import logging
+import resource
+import time
+
+from collections.abc import Iterator
+from ctypes import set_errno
+from socket import socket, AF_INET, SOCK_DGRAM
+from struct import Struct
+from typing import Final
+
+import pytest
+
+import can_peak_gateway
+
+from can import AsyncBufferedReader, Message, Notifier
+from can_peak_gateway import (
+    BusPeakGateway,
+    HEADER_SIZE,
+    KIND_CAN_FRAME,
+    KIND_CAN_FRAME_CRC,
+    RECV_BATCH_SIZE,
+    SEND_BATCH_SIZE,
+    MessageHeader,
+    SocketReader,
+    pack_frame,
+)
+
+WIRE_HEADER: Final[Struct] = Struct(">HHQIIBBHI")
+# Stand-in for the trailing CRC, its algorithm is not confirmed yet so the bus does not check it.
+CRC_PLACEHOLDER: Final[bytes] = b"\xde\xad\xbe\xef"
+
+
+def encode_frame(frame_id: int, data: bytes, frame_kind: int = KIND_CAN_FRAME, dlc: int | None = None) -> bytes:
+    payload: bytes = data.ljust(8, b"\x00")
+    frame_size: int = len(data) if dlc is None else dlc
+    crc_size: int = 4 if frame_kind == KIND_CAN_FRAME_CRC else 0
+    packet_size: int = WIRE_HEADER.size + len(payload) + crc_size
+    frame: bytes = WIRE_HEADER.pack(packet_size, frame_kind, 0, 0, 0, 0, frame_size, 0, frame_id) + payload
+    if crc_size:
+        frame += CRC_PLACEHOLDER
+
+    return frame
+
+
+def inject(port: int, datagram: bytes) -> None:
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.sendto(datagram, ("127.0.0.1", port))
+
+
+def free_port() -> int:
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def port() -> int:
+    return free_port()
+
+
+@pytest.fixture
+def bus(port: int) -> Iterator[BusPeakGateway]:
+    # The bus sends to its own receive port, so sent frames come back through the receive path.
+    bus: BusPeakGateway = BusPeakGateway(send_host="127.0.0.1", send_port=port, recv_host="127.0.0.1", recv_port=port)
+    yield bus
+    bus.shutdown()
+
+
+def test_recv_port_is_exclusive(bus: BusPeakGateway, port: int) -> None:
+    with pytest.raises(OSError):
+        BusPeakGateway(send_host="127.0.0.1", send_port=port, recv_host="127.0.0.1", recv_port=port)
+
+
+def test_send_recv_roundtrip(bus: BusPeakGateway) -> None:
+    bus.send(Message(arbitration_id=0x45, data=[1, 2, 3], is_extended_id=False))
+
+    message: Message | None = bus.recv(1.0)
+    assert message is not None
+    assert message.arbitration_id == 0x45
+    assert message.data == bytearray([1, 2, 3])
+
+
+def test_notifier_delivers_every_frame_of_a_datagram(bus: BusPeakGateway, port: int) -> None:
+    async def receive() -> list[int]:
+        reader: AsyncBufferedReader = AsyncBufferedReader()
+        notifier: Notifier = Notifier(bus, [reader], timeout=0.1, loop=asyncio.get_running_loop())
+        try:
+            inject(port, encode_frame(1, b"\x01") + encode_frame(2, b"\x02") + encode_frame(3, b"\x03"))
+            return [(await asyncio.wait_for(reader.get_message(), 1.0)).arbitration_id for _ in range(3)]
+        finally:
+            notifier.stop()
+
+    assert asyncio.run(receive()) == [1, 2, 3]
+
+
+def test_pending_drains_past_dropped_frame(bus: BusPeakGateway, port: int) -> None:
+    inject(port, encode_frame(1, b"\x01") + encode_frame(2, b"\x02", frame_kind=0x99) + encode_frame(3, b"\x03"))
+
+    message: Message | None = bus.recv(1.0)
+    assert message is not None and message.arbitration_id == 1
+    assert bus.pending
+
+    received: list[int] = []
+    while bus.pending:
+        if (message := bus.recv(0)) is not None:
+            received.append(message.arbitration_id)
+
+    assert received == [3]
+    assert bus.recv(0) is None
+
+
+def test_packed_header_matches_message_header() -> None:
+    buffer: bytearray = bytearray(HEADER_SIZE + 8)
+    packet_size: int = pack_frame(Message(arbitration_id=0x123, data=[1, 2]), memoryview(buffer))
+
+    header: MessageHeader = MessageHeader.from_buffer_copy(buffer)
+    assert (header.packet_size, header.frame_kind, header.frame_size, header.frame_id) == (packet_size, 0x80, 2, 0x123)
+    assert (header.unused_tag, header.timestamp_low, header.timestamp_high, header.channel) == (0, 0, 0, 0)
+
+
+def test_classic_frame_payload_is_capped_at_8_bytes(bus: BusPeakGateway, port: int) -> None:
+    inject(port, encode_frame(1, bytes(range(8)), frame_kind=KIND_CAN_FRAME_CRC, dlc=12) + encode_frame(2, b"\x02"))
+
+    message: Message | None = bus.recv(1.0)
+    assert message is not None
+    assert message.dlc == 8
+    assert message.data == bytearray(range(8))
+
+    message = bus.recv(1.0)
+    assert message is not None and message.arbitration_id == 2
+
+
+def test_pack_frame_accepts_non_bool_flags() -> None:
+    expected: bytearray = bytearray(HEADER_SIZE + 8)
+    pack_frame(Message(arbitration_id=0x123, data=[1], is_extended_id=True), memoryview(expected))
+
+    buffer: bytearray = bytearray(HEADER_SIZE + 8)
+    message: Message = Message(arbitration_id=0x123, data=[1], is_extended_id=1)
+    message.is_error_frame = None
+    pack_frame(message, memoryview(buffer))
+
+    assert buffer == expected
+
+
+def test_crc_frame_is_kept_without_checking_crc(
+    bus: BusPeakGateway, port: int, caplog: pytest.LogCaptureFixture
+) -> None:
+    inject(port, encode_frame(1, b"\x01", frame_kind=KIND_CAN_FRAME_CRC))
+
+    with caplog.at_level(logging.WARNING):
+        message: Message | None = bus.recv(1.0)
+
+    assert message is not None and message.arbitration_id == 1
+    assert message.data == bytearray(b"\x01")
+    assert not caplog.records
+
+
+def test_timed_recv_with_high_file_descriptor(port: int) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < 1200:
+        pytest.skip("not enough file descriptors available")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1200), hard))
+
+    # Push the bus sockets past the 1024 file descriptors select() can handle.
+    sockets: list[socket] = [socket(AF_INET, SOCK_DGRAM) for _ in range(1100)]
+    try:
+        bus: BusPeakGateway = BusPeakGateway(
+            send_host="127.0.0.1", send_port=port, recv_host="127.0.0.1", recv_port=port
+        )
+        try:
+            assert bus.recv(0.05) is None
+            inject(port, encode_frame(1, b"\x01"))
+            message: Message | None = bus.recv(1.0)
+            assert message is not None and message.arbitration_id == 1
+        finally:
+            bus.shutdown()
+    finally:
+        for sock in sockets:
+            sock.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_recv_drains_more_datagrams_than_a_batch(
+    bus: BusPeakGateway, port: int, batched: bool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    if not batched:
+        monkeypatch.setattr(can_peak_gateway, "libc_function", lambda name, argtypes: None)
+        bus._recv_buffer = SocketReader(bus._recv_socket)
+    elif bus._recv_buffer._recvmmsg is None:
+        pytest.skip("recvmmsg is not available")
+
+    count: int = RECV_BATCH_SIZE * 2 + 3
+    before: float = time.time()
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        for i in range(count):
+            sock.sendto(encode_frame(i, bytes([i])), ("127.0.0.1", port))
+    after: float = time.time()
+
+    messages: list[Message] = []
+    while (message := bus.recv(0.2)) is not None:
+        messages.append(message)
+
+    assert [message.arbitration_id for message in messages] == list(range(count))
+    # The kernel stamps each datagram on arrival, before the first one is read.
+    assert all(before <= message.timestamp <= after for message in messages)
+    assert not bus.pending
+
+
+def batch_messages() -> list[Message]:
+    messages: list[Message] = [
+        Message(arbitration_id=i, data=[i & 0xFF], is_extended_id=False) for i in range(SEND_BATCH_SIZE * 2 + 5)
+    ]
+    messages.append(
+        Message(arbitration_id=0x7FF, data=bytes(range(64)), is_extended_id=False, is_fd=True, bitrate_switch=True)
+    )
+    return messages
+
+
+def receive_all(bus: BusPeakGateway) -> list[Message]:
+    messages: list[Message] = []
+    while (message := bus.recv(0.2)) is not None:
+        messages.append(message)
+
+    return messages
+
+
+def assert_same_frames(received: list[Message], sent: list[Message]) -> None:
+    assert [message.arbitration_id for message in received] == [message.arbitration_id for message in sent]
+    assert [bytes(message.data) for message in received] == [bytes(message.data) for message in sent]
+    assert received[-1].is_fd and received[-1].bitrate_switch
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_send_batch_delivers_more_messages_than_a_batch(bus: BusPeakGateway, batched: bool) -> None:
+    if not batched:
+        bus._send_batch._sendmmsg = None
+    elif bus._send_batch._sendmmsg is None:
+        pytest.skip("sendmmsg is not available")
+
+    sent: list[Message] = batch_messages()
+    bus.send_batch(sent)
+
+    assert_same_frames(receive_all(bus), sent)
+
+
+def test_send_batch_retries_interrupted_sendmmsg(bus: BusPeakGateway) -> None:
+    sendmmsg = bus._send_batch._sendmmsg
+    if sendmmsg is None:
+        pytest.skip("sendmmsg is not available")
+
+    interrupted: list[bool] = []
+
+    def interrupt_once(*args: object) -> int:
+        if not interrupted:
+            interrupted.append(True)
+            set_errno(errno.EINTR)
+            return -1
+        return sendmmsg(*args)
+
+    bus._send_batch._sendmmsg = interrupt_once
+    sent: list[Message] = batch_messages()
+    bus.send_batch(sent)
+
+    assert interrupted
+    assert_same_frames(receive_all(bus), sent)